@@ -1,18 +1,69 @@
-import base64
-import gzip
+import binascii
+import functools
 import os
 import platform
 import shutil
+import stat
 import subprocess  # nosec B404
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
 from pathlib import Path
 from threading import Event, RLock, Thread
-from typing import Optional
+from typing import List, Optional, Tuple
+
+try:
+    # pybase64 dispatches to SIMD (SSSE3/AVX2/NEON) kernels, which matters for the MB-sized HTML summaries
+    from pybase64 import b64encode
+except ImportError:
+    # Same as base64.b64encode, minus its Python-level wrapper
+    b64encode = functools.partial(binascii.b2a_base64, newline=False)
+
+try:
+    # ISA-L's deflate / CRC32 are SIMD-accelerated (AVX-512 on x86_64, NEON + CRC32 extensions on aarch64),
+    # and isal_zlib is API-compatible with zlib for our use.
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib  # type: ignore[no-redef, unused-ignore]  # only a redefinition when isal is installed
 
 DEFAULT_POLLING_INTERVAL_SECONDS = 5
 STOP_TIMEOUT_SECONDS = 2
 PERFSPECT_DATA_DIRECTORY = "/tmp/perfspect_data"
+# Read size for streaming the HTML summary through the compressor and base64 encoder
+_HTML_CHUNK_SIZE = 57 * 1024
+# zlib window bits selecting the gzip container format
+_GZIP_WBITS = 31
+# The HTML only needs to be transportable; higher levels cost several times the CPU for a marginally better ratio
+_HTML_COMPRESSION_LEVEL = 1
+# perfspect names its output files after the hostname
+_NODE = platform.node()
+
+# (inode, size, mtime) - changes whenever perfspect rewrites or replaces a file
+_FileSignature = Tuple[int, int, int]
+
+
+def _get_file_signature(path: str) -> Optional[_FileSignature]:
+    """
+    Returns the signature of the regular file at path, or None if there is no such file or it is still empty
+    (perfspect creates its output files before writing to them).
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _is_executable_file(path: Path) -> bool:
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return False
+    if not stat.S_ISREG(mode):
+        return False
+    # access(2) also accounts for noexec mounts and LSMs, which the mode bits don't reflect (even for root)
+    return os.access(path, os.X_OK, effective_ids=True)
 
 
 @dataclass
@@ -64,52 +115,65 @@ class HWMetricsMonitor(HWMetricsMonitorBase):
         self._thread: Optional[Thread] = None
         self._lock = RLock()
         self._ps_process: Optional[subprocess.Popen[bytes]] = None
-        self._perfspect_path: Optional[Path] = perfspect_path
-        self._perfspect_duration = perfspect_duration
         self._verbose = verbose
 
-        self._ps_raw_csv_filename = PERFSPECT_DATA_DIRECTORY + "/" + platform.node() + "_metrics.csv"
-        self._ps_summary_csv_filename = PERFSPECT_DATA_DIRECTORY + "/" + platform.node() + "_metrics_summary.csv"
-        self._ps_summary_html_filename = PERFSPECT_DATA_DIRECTORY + "/" + platform.node() + "_metrics_summary.html"
-        self._ps_latest_csv_filename = PERFSPECT_DATA_DIRECTORY + "/" + platform.node() + "_metrics_summary_latest.csv"
-        self._ps_latest_html_filename = (
-            PERFSPECT_DATA_DIRECTORY + "/" + platform.node() + "_metrics_summary_latest.html"
-        )
+        self._ps_cmd: Optional[List[str]] = None
+        if perfspect_path is not None and _is_executable_file(perfspect_path):
+            self._ps_cmd = [
+                str(perfspect_path),
+                "metrics",
+                "--duration",
+                str(perfspect_duration),
+                "--output",
+                PERFSPECT_DATA_DIRECTORY,
+            ]
+
+            # Add --debug if verbose is enabled
+            if verbose:
+                self._ps_cmd.append("--debug")
+
+        ps_filename_prefix = f"{PERFSPECT_DATA_DIRECTORY}/{_NODE}_metrics"
+        self._ps_summary_csv_filename = f"{ps_filename_prefix}_summary.csv"
+        self._ps_summary_html_filename = f"{ps_filename_prefix}_summary.html"
+
+        # perfspect rewrites its summaries only once per --duration, while we're asked for them on every snapshot;
+        # keep the last parsed / encoded results until the files change.
+        self._summary_csv_signature: Optional[_FileSignature] = None
+        self._summary_dict: Optional[dict] = None
+        self._summary_html_signature: Optional[_FileSignature] = None
+        self._summary_html: Optional[str] = None
 
         self._cleanup()
 
     def start(self) -> None:
-        if (
-            self._perfspect_path is None
-            or not os.path.isfile(self._perfspect_path)
-            or not os.access(self._perfspect_path, os.X_OK)
-        ):
+        if self._ps_cmd is None:
             return None
 
-        ps_cmd = [
-            str(self._perfspect_path),
-            "metrics",
-            "--duration",
-            str(self._perfspect_duration),
-            "--output",
-            PERFSPECT_DATA_DIRECTORY,
-        ]
-
-        # Add --debug if verbose is enabled
-        if self._verbose:
-            ps_cmd.append("--debug")
+        # Nothing reads perfspect's output - don't let it fill up a pipe and block. Let it through when verbose.
+        ps_process = subprocess.Popen(self._ps_cmd, stdout=None if self._verbose else subprocess.DEVNULL)
+        # The lock only guards the process handle; spawning, reaping and terminating happen outside of it
+        with self._lock:
+            self._ps_process = ps_process
+        Thread(target=self._reap_ps_process, args=(ps_process,), daemon=True).start()
 
-        self._ps_process = subprocess.Popen(ps_cmd, stdout=subprocess.PIPE)
-        Thread(target=self._reap_ps_process, daemon=True).start()
-
-    def _reap_ps_process(self) -> None:
-        if self._ps_process is not None:
-            self._ps_process.wait()
-            self._ps_process = None
+    def _reap_ps_process(self, ps_process: subprocess.Popen[bytes]) -> None:
+        ps_process.wait()
+        with self._lock:
+            # Don't drop the handle of a perfspect started after this one
+            if self._ps_process is ps_process:
+                self._ps_process = None
 
     def stop(self) -> None:
-        if self._ps_process:
-            self._ps_process.terminate()
+        with self._lock:
+            ps_process, self._ps_process = self._ps_process, None
+        if ps_process is not None:
+            ps_process.terminate()
+            # Let perfspect exit before cleaning up, so it doesn't write into the directory while we remove it
+            try:
+                ps_process.wait(STOP_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                ps_process.kill()
+                ps_process.wait()
 
         self._cleanup()
         self._thread = None
@@ -121,62 +185,64 @@ class HWMetricsMonitor(HWMetricsMonitorBase):
         # with the old data
         # and to ensure that the directory is empty
         # before starting the new process
-        if not os.path.exists(PERFSPECT_DATA_DIRECTORY):
-            os.makedirs(PERFSPECT_DATA_DIRECTORY)
-        else:
-            if os.path.exists(self._ps_raw_csv_filename):
-                os.remove(self._ps_raw_csv_filename)
-            if os.path.exists(self._ps_summary_csv_filename):
-                os.remove(self._ps_summary_csv_filename)
-            if os.path.exists(self._ps_summary_html_filename):
-                os.remove(self._ps_summary_html_filename)
+        try:
+            shutil.rmtree(PERFSPECT_DATA_DIRECTORY)
+        except FileNotFoundError:
+            # Either there's no directory, or an entry vanished while it was being removed - in which case
+            # remove the rest. Any other error (e.g stale output we can't remove) is raised.
+            if os.path.isdir(PERFSPECT_DATA_DIRECTORY):
+                shutil.rmtree(PERFSPECT_DATA_DIRECTORY)
+        os.makedirs(PERFSPECT_DATA_DIRECTORY, exist_ok=True)
 
     def _get_hw_metrics_dict(self) -> Optional[dict]:
-        summary_dict = {}
-        if os.path.exists(self._ps_summary_csv_filename) and os.path.isfile(self._ps_summary_csv_filename):
-            shutil.copy(self._ps_summary_csv_filename, self._ps_latest_csv_filename)
-            with open(self._ps_latest_csv_filename, "r") as f:
+        signature = _get_file_signature(self._ps_summary_csv_filename)
+        if signature is None:
+            return None
+
+        if signature != self._summary_csv_signature:
+            summary_dict = {}
+            with open(self._ps_summary_csv_filename, "r") as f:
                 next(f)  # Skip the first line
                 for line in f:
-                    csv_data = line.split(",")
-                    summary_dict[csv_data[0]] = csv_data[1]
+                    # Only the first two columns are used; partition() stops scanning at the delimiter
+                    # instead of splitting the whole (wide) row into a list.
+                    metric, _, rest = line.partition(",")
+                    value, _, _ = rest.partition(",")
+                    summary_dict[metric] = value
 
-            os.remove(self._ps_latest_csv_filename)
-            return summary_dict
+            self._summary_csv_signature = signature
+            self._summary_dict = summary_dict
 
-        else:
-            return None
+        return self._summary_dict
 
     def _get_hw_metrics_html(self) -> Optional[str]:
-        if os.path.exists(self._ps_summary_html_filename) and os.path.isfile(self._ps_summary_html_filename):
-            encoded_html_data = None
-            shutil.copy(self._ps_summary_html_filename, self._ps_latest_html_filename)
-            with open(self._ps_latest_html_filename, "rb") as f:
-                html_data = f.read()
-                # Compress the HTML data using gzip
-                compressed_html_data = gzip.compress(html_data)
-
-                # For debug, save the compressed HTML data to a file
-                # compressed_html_filename = self._ps_latest_html_filename + ".gz"
-                # with open(compressed_html_filename, "wb") as compressed_html_file:
-                #     compressed_html_file.write(compressed_html_data)
-                #     compressed_html_file.close()
-
-                # Encode the compressed HTML data to base64
-                encoded_html_data = base64.b64encode(compressed_html_data).decode("utf-8")
-
-                # For debug, save the base64 encoded HTML data to a file
-                # encoded_html_filename = self._ps_latest_html_filename + ".b64"
-                # with open(encoded_html_filename, "w") as encoded_html_file:
-                #     encoded_html_file.write(encoded_html_data)
-                # encoded_html_file.close()
-
-            os.remove(self._ps_latest_html_filename)
-            return encoded_html_data
-
-        else:
+        signature = _get_file_signature(self._ps_summary_html_filename)
+        if signature is None:
             return None
 
+        if signature != self._summary_html_signature:
+            # Compress (gzip) and base64-encode the HTML in a single streaming pass, so that only a chunk
+            # of the raw / compressed data is held in memory at any time.
+            compressor = zlib.compressobj(_HTML_COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+            encoded_html_data = bytearray()
+            pending = bytearray()
+            # Read every chunk into the same buffer, straight from the (unbuffered) file
+            chunk = memoryview(bytearray(_HTML_CHUNK_SIZE))
+            with open(self._ps_summary_html_filename, "rb", buffering=0) as f:
+                while read_size := f.readinto(chunk):
+                    pending += compressor.compress(chunk[:read_size])
+                    # Encode only whole 3-byte groups, so no base64 padding is emitted mid-stream
+                    encodable = len(pending) - len(pending) % 3
+                    encoded_html_data += b64encode(pending[:encodable])
+                    del pending[:encodable]
+
+            pending += compressor.flush()
+            encoded_html_data += b64encode(pending)
+            self._summary_html_signature = signature
+            self._summary_html = encoded_html_data.decode("ascii")
+
+        return self._summary_html
+
 
 class NoopHWMetricsMonitor(HWMetricsMonitorBase):
     def start(self) -> None:
@@ -0,0 +1,210 @@
+#
+# Copyright (C) 2022 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the logic from gprofiler/hw_metrics.py
+"""
+
+import base64
+import binascii
+import functools
+import gzip
+import os
+import random
+import shutil
+import signal
+import zlib
+from pathlib import Path
+from threading import Event
+from typing import Any, NoReturn
+
+import pytest
+from pytest import FixtureRequest, MonkeyPatch
+
+from gprofiler import hw_metrics
+from gprofiler.hw_metrics import _HTML_CHUNK_SIZE, HWMetricsMonitor
+
+
+@pytest.fixture(params=["binascii", "pybase64"])
+def b64encode(request: FixtureRequest, monkeypatch: MonkeyPatch) -> None:
+    if request.param == "binascii":
+        encoder = functools.partial(binascii.b2a_base64, newline=False)
+    else:
+        encoder = pytest.importorskip("pybase64").b64encode
+    monkeypatch.setattr(hw_metrics, "b64encode", encoder)
+
+
+@pytest.fixture(params=["zlib", "isal"])
+def compressor(request: FixtureRequest, monkeypatch: MonkeyPatch) -> None:
+    module = zlib if request.param == "zlib" else pytest.importorskip("isal.isal_zlib")
+    monkeypatch.setattr(hw_metrics, "zlib", module)
+
+
+@pytest.fixture
+def hw_metrics_monitor(tmp_path: Path, monkeypatch: MonkeyPatch) -> HWMetricsMonitor:
+    monkeypatch.setattr(hw_metrics, "PERFSPECT_DATA_DIRECTORY", str(tmp_path / "perfspect_data"))
+    return HWMetricsMonitor(Event())
+
+
+@pytest.mark.parametrize(
+    "size",
+    [
+        1,
+        2,
+        3,
+        4,
+        _HTML_CHUNK_SIZE - 1,
+        _HTML_CHUNK_SIZE,
+        _HTML_CHUNK_SIZE + 1,
+        2 * _HTML_CHUNK_SIZE + 2,
+        3 * 1024 * 1024 + 1,
+    ],
+)
+@pytest.mark.parametrize("compressible", [True, False], ids=["html", "random"])
+@pytest.mark.usefixtures("b64encode", "compressor")
+def test_html_roundtrip(hw_metrics_monitor: HWMetricsMonitor, size: int, compressible: bool) -> None:
+    # Random data doesn't compress, so the compressed stream crosses chunk / 3-byte boundaries along with the input
+    if compressible:
+        html = (b"<html><body>" + b"<div>metric</div>" * size)[:size]
+    else:
+        html = random.Random(size).randbytes(size)
+    Path(hw_metrics_monitor._ps_summary_html_filename).write_bytes(html)
+
+    result = hw_metrics_monitor._get_hw_metrics_html()
+
+    assert result is not None
+    assert gzip.decompress(base64.b64decode(result, validate=True)) == html
+
+
+_SUMMARY = "metric,mean,max\nIPC,1.2,2.0\n"
+_SUMMARY_SAME_SIZE = "metric,mean,max\nIPC,1.5,2.0\n"
+_SUMMARY_LONGER = _SUMMARY + "CPI,0.8,1.0\n"
+_PARSED_SUMMARIES = {
+    _SUMMARY: {"IPC": "1.2"},
+    _SUMMARY_SAME_SIZE: {"IPC": "1.5"},
+    _SUMMARY_LONGER: {"IPC": "1.2", "CPI": "0.8"},
+}
+
+
+def _summary_path(monitor: HWMetricsMonitor, kind: str) -> Path:
+    return Path(monitor._ps_summary_csv_filename if kind == "csv" else monitor._ps_summary_html_filename)
+
+
+def _get_summary(monitor: HWMetricsMonitor, kind: str) -> Any:
+    return monitor._get_hw_metrics_dict() if kind == "csv" else monitor._get_hw_metrics_html()
+
+
+def _assert_summary(monitor: HWMetricsMonitor, kind: str, text: str) -> Any:
+    result = _get_summary(monitor, kind)
+    if kind == "csv":
+        assert result == _PARSED_SUMMARIES[text]
+    else:
+        assert gzip.decompress(base64.b64decode(result)).decode() == text
+    return result
+
+
+def _fail_open(*args: Any, **kwargs: Any) -> NoReturn:
+    raise AssertionError("summary file was re-read")
+
+
+@pytest.mark.parametrize("kind", ["csv", "html"])
+def test_summary_cached_while_unchanged(
+    hw_metrics_monitor: HWMetricsMonitor, kind: str, monkeypatch: MonkeyPatch
+) -> None:
+    _summary_path(hw_metrics_monitor, kind).write_text(_SUMMARY)
+    first = _assert_summary(hw_metrics_monitor, kind, _SUMMARY)
+
+    monkeypatch.setattr(hw_metrics, "open", _fail_open, raising=False)
+    assert _get_summary(hw_metrics_monitor, kind) is first
+
+
+@pytest.mark.parametrize("kind", ["csv", "html"])
+def test_summary_reread_when_size_changes(hw_metrics_monitor: HWMetricsMonitor, kind: str) -> None:
+    path = _summary_path(hw_metrics_monitor, kind)
+    path.write_text(_SUMMARY)
+    _assert_summary(hw_metrics_monitor, kind, _SUMMARY)
+    st = path.stat()
+
+    path.write_text(_SUMMARY_LONGER)
+    # Keep the mtime, so that only the size tells the files apart
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    _assert_summary(hw_metrics_monitor, kind, _SUMMARY_LONGER)
+
+
+@pytest.mark.parametrize("kind", ["csv", "html"])
+def test_summary_reread_when_mtime_changes(hw_metrics_monitor: HWMetricsMonitor, kind: str) -> None:
+    path = _summary_path(hw_metrics_monitor, kind)
+    path.write_text(_SUMMARY)
+    _assert_summary(hw_metrics_monitor, kind, _SUMMARY)
+    st = path.stat()
+
+    path.write_text(_SUMMARY_SAME_SIZE)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    _assert_summary(hw_metrics_monitor, kind, _SUMMARY_SAME_SIZE)
+
+
+@pytest.mark.parametrize("state", ["missing", "empty", "directory"])
+@pytest.mark.parametrize("kind", ["csv", "html"])
+def test_summary_unavailable(hw_metrics_monitor: HWMetricsMonitor, kind: str, state: str) -> None:
+    path = _summary_path(hw_metrics_monitor, kind)
+    if state == "empty":
+        path.touch()
+    elif state == "directory":
+        path.mkdir()
+
+    assert _get_summary(hw_metrics_monitor, kind) is None
+
+
+def test_cleanup_when_entry_vanishes(hw_metrics_monitor: HWMetricsMonitor, monkeypatch: MonkeyPatch) -> None:
+    data_directory = Path(hw_metrics.PERFSPECT_DATA_DIRECTORY)
+    (data_directory / "stale.csv").write_text(_SUMMARY)
+    rmtree = shutil.rmtree
+    calls = []
+
+    def racing_rmtree(path: str) -> None:
+        calls.append(path)
+        if len(calls) == 1:
+            # As if an entry was removed by someone else while rmtree was walking the directory
+            raise FileNotFoundError(path)
+        rmtree(path)
+
+    monkeypatch.setattr(shutil, "rmtree", racing_rmtree)
+    hw_metrics_monitor._cleanup()
+
+    assert len(calls) == 2
+    assert list(data_directory.iterdir()) == []
+
+
+def test_stop_waits_for_perfspect(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    data_directory = tmp_path / "perfspect_data"
+    monkeypatch.setattr(hw_metrics, "PERFSPECT_DATA_DIRECTORY", str(data_directory))
+    monkeypatch.setattr(hw_metrics, "STOP_TIMEOUT_SECONDS", 0.5)
+    # Ignores SIGTERM and keeps writing new files into the data directory (using shell builtins only, so that
+    # nothing outlives it)
+    perfspect = tmp_path / "perfspect"
+    perfspect.write_text(
+        f"#!/bin/sh\ntrap '' TERM\ni=0\nwhile true; do i=$((i + 1)); : > {data_directory}/out.$i; done\n"
+    )
+    perfspect.chmod(0o755)
+    monitor = HWMetricsMonitor(Event(), perfspect_path=perfspect)
+
+    monitor.start()
+    ps_process = monitor._ps_process
+    assert ps_process is not None
+    monitor.stop()
+
+    assert ps_process.returncode == -signal.SIGKILL
+    assert list(data_directory.iterdir()) == []